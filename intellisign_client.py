@@ -1,40 +1,162 @@
+import asyncio
+import functools
+import time
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
 
-import requests
+import aiofiles
+import aiofiles.os
+import aiohttp
+import orjson
+
+
+# Tamanho dos blocos lidos do disco ao enviar um PDF
+UPLOAD_CHUNK_SIZE = 1 << 16
+
+# Blocos adaptativos: ~1/64 do arquivo, entre 64KB e 4MB
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Acima disso o upload vai em chunked transfer encoding; abaixo, com Content-Length
+STREAM_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+
+# Retentativas para erros transitorios do gateway ou de conexao (so em metodos idempotentes)
+RETRY_STATUSES = (502, 503, 504)
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+# Timeout por chamada (o padrao do aiohttp e 5 minutos), para limitar quanto um envio demora
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=120, connect=10)
+# O PDF final e repassado em streaming: sem limite total, so entre leituras
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_read=60)
 
 
 class IntellisignAPIError(Exception):
     pass
 
 
+def translate_transport_errors(func):
+    """
+    Converte falhas de transporte (conexao, timeout, corpo truncado) em
+    IntellisignAPIError, para os endpoints tratarem igual aos erros da API.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise IntellisignAPIError(f"Falha de comunicacao com o Intellisign: {e!r}") from e
+
+    return wrapper
+
+
+def create_session(
+    pool_size: int = 50,
+    keepalive_timeout: float = 60.0,
+    timeout: aiohttp.ClientTimeout = REQUEST_TIMEOUT,
+) -> aiohttp.ClientSession:
+    """
+    Cria a sessao HTTP compartilhada pelo cliente: pool de conexoes
+    keep-alive, timeout explicito e Accept JSON como header padrao.
+
+    HTTP/1.1 com keep-alive: as chamadas em paralelo (gather) usam conexoes
+    do pool, e o keepalive_timeout mais longo que o padrao (15s) mantem as
+    conexoes vivas entre os polls de status.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=pool_size,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={"Accept": "application/json"},
+    )
+
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def adaptive_chunk_size(total_size: Optional[int]) -> int:
+    """
+    Escolhe o tamanho do bloco pelo tamanho total (quando conhecido), para
+    arquivos grandes nao custarem milhares de iteracoes em Python.
+    """
+    if not total_size:
+        return UPLOAD_CHUNK_SIZE
+    return min(max(total_size // 64, UPLOAD_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+async def read_json(resp: aiohttp.ClientResponse) -> Any:
+    return orjson.loads(await resp.read())
+
+
+async def iter_file_chunks(path: Path, chunk_size: int = UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Le o arquivo em blocos sem bloquear o event loop, para que o upload
+    seja enviado em streaming sem carregar o PDF inteiro em memoria.
+    """
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+
+
 class IntellisignClient:
     """
     Cliente fino para a API do Intellisign.
 
     Usa OAuth2 client_credentials para pegar um access_token e depois
     chama endpoints /v1 de envelopes e documentos.
+
+    A sessao aiohttp e compartilhada entre chamadas (criada no startup da
+    aplicacao) para reaproveitar as conexoes keep-alive com o Intellisign.
+    O access_token fica em cache ate perto de expirar.
     """
 
+    # Margem de seguranca (segundos) antes do expires_in do token
+    TOKEN_EXPIRY_MARGIN = 60
+
     def __init__(
         self,
         base_url: str,
         client_id: str,
         client_secret: str,
+        session: aiohttp.ClientSession,
         scope: str = "*",
     ):
         self.base_url = base_url.rstrip("/")
         self.client_id = client_id
         self.client_secret = client_secret
         self.scope = scope
+        self._session = session
+        self._token: Optional[str] = None
+        self._auth_header: str = ""
+        self._token_exp: float = 0.0
+        self._token_lock = asyncio.Lock()
+
+    async def close(self):
+        await self._session.close()
 
     # ---------- Auth ----------
 
-    def get_access_token(self) -> str:
+    async def get_access_token(self) -> str:
         """
         Usa OAuth2 client_credentials para pegar um token.
         No projeto original os endpoints estao em /oauth/token.
+
+        Reaproveita o token em cache enquanto ele for valido; o lock evita
+        que requisicoes concorrentes disparem varias renovacoes ao mesmo tempo.
         """
+        if self._token and time.monotonic() < self._token_exp:
+            return self._token
+        async with self._token_lock:
+            if self._token and time.monotonic() < self._token_exp:
+                return self._token
+            return await self._fetch_access_token()
+
+    @translate_transport_errors
+    async def _fetch_access_token(self) -> str:
         token_url = f"{self.base_url}/oauth/token"
         data = {
             "grant_type": "client_credentials",
@@ -42,43 +164,110 @@ class IntellisignClient:
             "client_secret": self.client_secret,
             "scope": self.scope,
         }
-        resp = requests.post(token_url, json=data)
-        if resp.status_code != 200:
-            raise IntellisignAPIError(
-                f"Erro ao obter token ({resp.status_code}): {resp.text}"
-            )
-        return resp.json()["access_token"]
+        async with self._session.post(token_url, data=orjson.dumps(data), headers=JSON_HEADERS) as resp:
+            if resp.status != 200:
+                raise IntellisignAPIError(
+                    f"Erro ao obter token ({resp.status}): {await resp.text()}"
+                )
+            data = await read_json(resp)
+        expires_in = int(data.get("expires_in") or 3600)
+        self._token = data["access_token"]
+        self._auth_header = f"Bearer {self._token}"
+        self._token_exp = time.monotonic() + expires_in - self.TOKEN_EXPIRY_MARGIN
+        return self._token
+
+    def invalidate_token(self, access_token: Optional[str] = None):
+        """
+        Descarta o token em cache (ex.: revogado no servidor).
+        Se access_token for informado, so descarta se ainda for o token atual.
+        """
+        if access_token is None or access_token == self._token:
+            self._token = None
+            self._token_exp = 0.0
 
     def _headers(self, access_token: str, extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Accept": "application/json",
-        }
+        # Accept ja vem da sessao (create_session); o header do token em cache
+        # e montado uma vez so, na renovacao
+        if access_token == self._token:
+            auth_header = self._auth_header
+        else:
+            auth_header = f"Bearer {access_token}"
         if extra:
-            headers.update(extra)
-        return headers
+            return {"Authorization": auth_header, **extra}
+        return {"Authorization": auth_header}
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        access_token: str,
+        headers: Optional[Dict[str, str]] = None,
+        data_factory: Optional[Callable[[], Awaitable[Any]]] = None,
+        **kwargs: Any,
+    ) -> aiohttp.ClientResponse:
+        """
+        Faz uma chamada autenticada. Em 401 descarta o token em cache e
+        tenta mais uma vez com um token novo. Em 502/503/504 ou erro de
+        conexao repete metodos idempotentes com backoff exponencial.
+
+        data_factory monta o corpo a cada tentativa (FormData nao pode ser
+        reenviado).
+        """
+        auth_retried = False
+        retries = 0
+        while True:
+            if data_factory is not None:
+                kwargs["data"] = await data_factory()
+            retryable = method in IDEMPOTENT_METHODS and retries < RETRY_TOTAL
+            try:
+                resp = await self._session.request(
+                    method, url, headers=self._headers(access_token, headers), **kwargs
+                )
+            except aiohttp.ClientConnectionError:
+                # Conexao keep-alive derrubada pelo servidor, reset, etc.
+                if not retryable:
+                    raise
+                await asyncio.sleep(RETRY_BACKOFF * (2 ** retries))
+                retries += 1
+                continue
+            if resp.status == 401 and not auth_retried:
+                resp.release()
+                auth_retried = True
+                self.invalidate_token(access_token)
+                access_token = await self.get_access_token()
+                continue
+            if resp.status in RETRY_STATUSES and retryable:
+                resp.release()
+                await asyncio.sleep(RETRY_BACKOFF * (2 ** retries))
+                retries += 1
+                continue
+            return resp
 
     # ---------- Envelopes ----------
 
-    def create_envelope(self, access_token: str, name: str, subject: str, message: str) -> str:
+    @translate_transport_errors
+    async def create_envelope(self, access_token: str, name: str, subject: str, message: str) -> str:
         url = f"{self.base_url}/v1/envelopes"
         body: Dict[str, Any] = {
             "title": name,
             "subject": subject,
             "message": message,
         }
-        resp = requests.post(url, json=body, headers=self._headers(access_token))
-        if resp.status_code not in (200, 201):
-            raise IntellisignAPIError(
-                f"Erro ao criar envelope ({resp.status_code}): {resp.text}"
-            )
-        data = resp.json()
+        async with await self._request(
+            "POST", url, access_token, data=orjson.dumps(body), headers=JSON_HEADERS
+        ) as resp:
+            if resp.status not in (200, 201):
+                raise IntellisignAPIError(
+                    f"Erro ao criar envelope ({resp.status}): {await resp.text()}"
+                )
+            data = await read_json(resp)
         envelope_id = data.get("id") or data.get("envelope_id")
         if not envelope_id:
             raise IntellisignAPIError("Envelope sem id na resposta")
         return envelope_id
 
-    def add_document(
+    @translate_transport_errors
+    async def add_document(
         self,
         access_token: str,
         envelope_id: str,
@@ -86,28 +275,42 @@ class IntellisignClient:
         filename: str = "document.pdf",
     ) -> str:
         """
-        Faz upload de um PDF para o envelope.
+        Faz upload de um PDF para o envelope, sempre em streaming direto do
+        disco. PDFs grandes vao em chunked transfer encoding; os pequenos com
+        Content-Length.
         """
         url = f"{self.base_url}/v1/envelopes/{envelope_id}/documents"
-        with file_path.open("rb") as f:
-            files = {
-                "file": (filename, f, "application/pdf"),
-            }
-            data = {
-                "name": filename,
-                "stage": "original",
-            }
-            resp = requests.post(
-                url, headers=self._headers(access_token), files=files, data=data
-            )
-        if resp.status_code not in (200, 201):
-            raise IntellisignAPIError(
-                f"Erro ao enviar documento ({resp.status_code}): {resp.text}"
+        file_size = (await aiofiles.os.stat(file_path)).st_size
+        chunk_size = adaptive_chunk_size(file_size)
+
+        async def build_form() -> aiohttp.FormData:
+            # Um corpo novo a cada tentativa. Arquivo pequeno: objeto de arquivo
+            # aberto, que o aiohttp le em blocos fora do event loop e com tamanho
+            # conhecido. Arquivo grande: gerador com blocos adaptativos.
+            if file_size <= STREAM_UPLOAD_THRESHOLD:
+                file_field = await asyncio.to_thread(file_path.open, "rb")
+            else:
+                file_field = iter_file_chunks(file_path, chunk_size)
+            form = aiohttp.FormData()
+            form.add_field("name", filename)
+            form.add_field("stage", "original")
+            form.add_field(
+                "file", file_field, filename=filename, content_type="application/pdf"
             )
-        data = resp.json()
+            return form
+
+        async with await self._request(
+            "POST", url, access_token, data_factory=build_form
+        ) as resp:
+            if resp.status not in (200, 201):
+                raise IntellisignAPIError(
+                    f"Erro ao enviar documento ({resp.status}): {await resp.text()}"
+                )
+            data = await read_json(resp)
         return data.get("id") or ""
 
-    def add_recipient(
+    @translate_transport_errors
+    async def add_recipient(
         self,
         access_token: str,
         envelope_id: str,
@@ -134,40 +337,38 @@ class IntellisignClient:
         if routing_order is not None:
             body["routing_order"] = routing_order
 
-        resp = requests.post(url, json=body, headers=self._headers(access_token))
-        if resp.status_code not in (200, 201):
-            raise IntellisignAPIError(
-                f"Erro ao adicionar destinatario ({resp.status_code}): {resp.text}"
-            )
+        async with await self._request(
+            "POST", url, access_token, data=orjson.dumps(body), headers=JSON_HEADERS
+        ) as resp:
+            if resp.status not in (200, 201):
+                raise IntellisignAPIError(
+                    f"Erro ao adicionar destinatario ({resp.status}): {await resp.text()}"
+                )
 
-    def send_envelope(self, access_token: str, envelope_id: str):
+    @translate_transport_errors
+    async def send_envelope(self, access_token: str, envelope_id: str):
         url = f"{self.base_url}/v1/envelopes/{envelope_id}/send"
-        resp = requests.post(url, headers=self._headers(access_token))
-        # Alguns provedores auto-enviam quando adiciona destinatario; se der 404, trate conforme necessario.
-        if resp.status_code not in (200, 201, 202, 204):
-            raise IntellisignAPIError(
-                f"Erro ao enviar envelope ({resp.status_code}): {resp.text}"
-            )
+        async with await self._request("POST", url, access_token) as resp:
+            # Alguns provedores auto-enviam quando adiciona destinatario; se der 404, trate conforme necessario.
+            if resp.status not in (200, 201, 202, 204):
+                raise IntellisignAPIError(
+                    f"Erro ao enviar envelope ({resp.status}): {await resp.text()}"
+                )
 
-    def get_envelope_status(self, access_token: str, envelope_id: str) -> Dict[str, Any]:
+    @translate_transport_errors
+    async def get_envelope_status(self, access_token: str, envelope_id: str) -> Dict[str, Any]:
         url = f"{self.base_url}/v1/envelopes/{envelope_id}"
-        resp = requests.get(url, headers=self._headers(access_token))
-        if resp.status_code != 200:
-            raise IntellisignAPIError(
-                f"Erro ao consultar envelope ({resp.status_code}): {resp.text}"
-            )
-        return resp.json()
+        async with await self._request("GET", url, access_token) as resp:
+            if resp.status != 200:
+                raise IntellisignAPIError(
+                    f"Erro ao consultar envelope ({resp.status}): {await resp.text()}"
+                )
+            return await read_json(resp)
 
-    def download_completed_document(
-        self,
-        access_token: str,
-        envelope_id: str,
-        destination: Path,
-    ):
+    def resolve_download_link(self, envelope_id: str, details: Dict[str, Any]) -> str:
         """
-        Baixa o PDF final do envelope usando as rotas ja testadas no projeto.
+        Extrai o link de download do PDF final a partir dos detalhes do envelope.
         """
-        details = self.get_envelope_status(access_token, envelope_id)
         docs = details.get("documents") or []
         if not docs:
             raise IntellisignAPIError("Nenhum documento encontrado no envelope")
@@ -179,22 +380,76 @@ class IntellisignClient:
             if not doc_id:
                 raise IntellisignAPIError("Documento sem id para download")
             download_link = f"{self.base_url}/v1/envelopes/{envelope_id}/documents/{doc_id}/download"
+        return download_link
 
-        resp = requests.get(
-            download_link,
-            headers=self._headers(access_token),
-            stream=True,
-        )
-        if resp.status_code != 200:
-            raise IntellisignAPIError(
-                f"Erro ao baixar documento ({resp.status_code}): {resp.text}"
-            )
+    @translate_transport_errors
+    async def open_completed_document(
+        self,
+        access_token: str,
+        envelope_id: str,
+        download_link: Optional[str] = None,
+    ) -> Tuple[aiohttp.ClientResponse, str]:
+        """
+        Abre a resposta de download do PDF final do envelope, ja validada.
+        O chamador consome o corpo (ex.: iter_response_chunks) e libera a resposta.
+        Se o download_link ja for conhecido, pula a consulta ao envelope; se ele
+        falhar (ex.: link expirado), resolve um novo uma vez.
+        Retorna a resposta e o link usado, para o chamador guardar o link novo.
+        """
+        cached_link = download_link
+        if not download_link:
+            details = await self.get_envelope_status(access_token, envelope_id)
+            download_link = self.resolve_download_link(envelope_id, details)
+
+        resp = await self._request("GET", download_link, access_token, timeout=DOWNLOAD_TIMEOUT)
+        if resp.status != 200 and cached_link:
+            resp.release()
+            details = await self.get_envelope_status(access_token, envelope_id)
+            download_link = self.resolve_download_link(envelope_id, details)
+            resp = await self._request("GET", download_link, access_token, timeout=DOWNLOAD_TIMEOUT)
+        if resp.status != 200:
+            async with resp:
+                raise IntellisignAPIError(
+                    f"Erro ao baixar documento ({resp.status}): {await resp.text()}"
+                )
+        return resp, download_link
 
-        destination.parent.mkdir(parents=True, exist_ok=True)
-        with destination.open("wb") as f:
-            for chunk in resp.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+    @translate_transport_errors
+    async def download_completed_document(
+        self,
+        access_token: str,
+        envelope_id: str,
+        destination: Path,
+        download_link: Optional[str] = None,
+    ) -> str:
+        """
+        Baixa o PDF final do envelope usando as rotas ja testadas no projeto.
+        Retorna o link usado (novo, se o informado falhou).
+        """
+        resp, download_link = await self.open_completed_document(access_token, envelope_id, download_link)
+        async with resp:
+            await aiofiles.os.makedirs(destination.parent, exist_ok=True)
+            async with aiofiles.open(destination, "wb") as f:
+                chunk_size = adaptive_chunk_size(resp.content_length)
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    await f.write(chunk)
+        return download_link
+
+
+async def iter_response_chunks(
+    resp: aiohttp.ClientResponse, chunk_size: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    """
+    Repassa o corpo da resposta em blocos e libera a conexao no fim,
+    para usar em StreamingResponse.
+    """
+    if chunk_size is None:
+        chunk_size = adaptive_chunk_size(resp.content_length)
+    try:
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            yield chunk
+    finally:
+        resp.release()
 
 
 # IMPORTANTE: confirme as rotas (/oauth/token, /v1/envelopes, /v1/envelopes/{id}/documents/{docId}/download) na doc oficial do Intellisign.
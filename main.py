@@ -1,23 +1,75 @@
+import asyncio
+import hashlib
+import hmac
+import io
 import logging
+import multiprocessing
 import os
+import shutil
+import time
 import uuid
-from datetime import datetime
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict
+from typing import BinaryIO, Dict
 
-from fastapi import Body, FastAPI, Form, HTTPException, UploadFile, File, Request
+import aiofiles
+import aiofiles.os
+import orjson
+import redis.asyncio as aioredis
+from fastapi import Body, Depends, FastAPI, Form, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
 
-from intellisign_client import IntellisignClient, IntellisignAPIError
+from intellisign_client import (
+    UPLOAD_CHUNK_SIZE,
+    IntellisignAPIError,
+    IntellisignClient,
+    create_session,
+    iter_response_chunks,
+)
 
 # ------------------ Configuração básica ------------------
 
+# Atributos padrão do LogRecord; o que sobrar veio de extra= e vai para o JSON
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Uma linha JSON por log, com severity/message no formato que o Cloud
+    Logging entende sem parsing. Campos passados em extra= entram no objeto.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
 logging.basicConfig(level=logging.INFO)
+logging.getLogger().handlers[0].setFormatter(JsonFormatter())
 logger = logging.getLogger("consent-backend")
 
 UPLOAD_ROOT = Path(os.getenv("UPLOAD_ROOT", "/app/uploads"))
+# PDFs ainda sem documentId (o id é o hash do conteúdo) ficam aqui até o hash fechar
+INCOMING_ROOT = UPLOAD_ROOT / ".incoming"
+# Com UPLOAD_PERSIST=1 o PDF assinado é gravado em disco; senão o download é repassado direto do Intellisign
+UPLOAD_PERSIST = os.getenv("UPLOAD_PERSIST", "0") == "1"
 
 INTELLISIGN_BASE_URL = os.getenv("INTELLISIGN_BASE_URL", "https://api.intellisign.com")
 INTELLISIGN_CLIENT_ID = os.getenv("INTELLISIGN_CLIENT_ID", "")
@@ -27,14 +79,89 @@ INTELLISIGN_SCOPE = os.getenv("INTELLISIGN_SCOPE", "*")
 SIGNER_NAME_DEFAULT = os.getenv("SIGNER_NAME_DEFAULT", "User")
 SIGNER_EMAIL_DEFAULT = os.getenv("SIGNER_EMAIL_DEFAULT", "test@example.com")
 
-client = IntellisignClient(
-    base_url=INTELLISIGN_BASE_URL,
-    client_id=INTELLISIGN_CLIENT_ID,
-    client_secret=INTELLISIGN_CLIENT_SECRET,
-    scope=INTELLISIGN_SCOPE,
-)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Tempo de vida do registro do consentimento (acompanha a validade do envelope)
+CONSENT_TTL_SECONDS = int(os.getenv("CONSENT_TTL_SECONDS", str(30 * 24 * 3600)))
+# Reserva do documentId enquanto o envio está em andamento: renovada durante o envio
+# e expira se o processo cair
+SEND_RESERVATION_SECONDS = int(os.getenv("SEND_RESERVATION_SECONDS", "300"))
+# Quanto um envio repetido espera o envio em andamento do mesmo documento terminar
+SEND_RESERVATION_WAIT_SECONDS = float(os.getenv("SEND_RESERVATION_WAIT_SECONDS", "10"))
+SENDING_STATUS = "sending"
+
+# Intervalo mínimo entre consultas ao Intellisign para o mesmo envelope
+STATUS_CACHE_SECONDS = float(os.getenv("STATUS_CACHE_SECONDS", "10"))
+
+# Com o segredo configurado, a conclusão chega por webhook e o /status só consulta o
+# Intellisign a cada WEBHOOK_STATUS_CACHE_SECONDS, como fallback para um evento perdido
+WEBHOOK_STATUS_CACHE_SECONDS = float(os.getenv("WEBHOOK_STATUS_CACHE_SECONDS", "600"))
+INTELLISIGN_WEBHOOK_SECRET = os.getenv("INTELLISIGN_WEBHOOK_SECRET", "")
+WEBHOOK_SIGNATURE_HEADER = "X-Intellisign-Signature"
+
+COMPLETED_ENVELOPE_STATUSES = ("completed", "signed", "finished")
+
+# Limite do PDF enviado em 'file' e assinatura (magic bytes) esperada no início
+MAX_PDF_BYTES = int(os.getenv("MAX_PDF_BYTES", str(25 * 1024 * 1024)))
+PDF_MAGIC = b"%PDF-"
+# Corpo máximo do /send: o PDF mais folga para os demais campos do multipart
+MAX_SEND_BODY_BYTES = MAX_PDF_BYTES + int(os.getenv("SEND_BODY_OVERHEAD_BYTES", str(1024 * 1024)))
+
+# PDFs gerados de textos até PDF_CACHE_MAX_CONTENT caracteres ficam em cache (bytes),
+# já que o termo padrão se repete entre usuários; textos maiores são sempre renderizados
+PDF_CACHE_MAX_CONTENT = int(os.getenv("PDF_CACHE_MAX_CONTENT", "20000"))
+PDF_CACHE_SIZE = int(os.getenv("PDF_CACHE_SIZE", "128"))
+
+# Máximo de chamadas simultâneas ao Intellisign por etapa no envio em lote
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))
+# Máximo de itens por lote
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "100"))
+
+ENVELOPE_MESSAGE = "Por favor, assine o termo de consentimento enviado pelo sistema."
 
-app = FastAPI(title="Consent Backend")
+DOWNLOAD_CACHE_CONTROL = "private, max-age=300"
+
+
+class BodySizeLimitMiddleware:
+    """
+    Recusa com 413 corpos acima de max_bytes nos paths indicados antes de o
+    Starlette gravar o multipart no disco temporário: pelo Content-Length ou,
+    sem ele (chunked), contando os bytes conforme chegam.
+    """
+
+    def __init__(self, app, max_bytes: int, paths: tuple[str, ...]):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = ORJSONResponse({"detail": "Corpo da requisição excede o tamanho máximo"}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail="Corpo da requisição excede o tamanho máximo")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app = FastAPI(title="Consent Backend", default_response_class=ORJSONResponse)
+
+# Antes do CORS, para a resposta 413 também levar os headers de CORS
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_SEND_BODY_BYTES, paths=("/api/consents/send",))
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,8 +171,162 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Memória simples: documentId -> info de status
-CONSENT_STORE: Dict[str, Dict] = {}
+
+# Cliente Intellisign com sessão HTTP compartilhada (criado no startup)
+intellisign_client: IntellisignClient | None = None
+
+# Redis: consent:{documentId} -> info de status (compartilhado entre workers/instâncias)
+consent_store: aioredis.Redis | None = None
+
+# Referências para tarefas em background não serem coletadas antes de terminar
+_background_tasks: set = set()
+
+# texto -> bytes do PDF renderizado (futures, para renderizações simultâneas do mesmo texto)
+_pdf_cache: "OrderedDict[str, asyncio.Future]" = OrderedDict()
+
+
+@app.on_event("startup")
+async def startup():
+    global intellisign_client, consent_store
+    consent_store = aioredis.from_url(REDIS_URL)
+    intellisign_client = IntellisignClient(
+        base_url=INTELLISIGN_BASE_URL,
+        client_id=INTELLISIGN_CLIENT_ID,
+        client_secret=INTELLISIGN_CLIENT_SECRET,
+        session=create_session(),
+        scope=INTELLISIGN_SCOPE,
+    )
+    # reportlab é CPU-bound e não libera o GIL: gera PDFs em processos separados.
+    # forkserver: os workers nascem sob demanda, quando o processo já tem threads
+    # (aiofiles, to_thread), e um fork de processo com threads pode travar
+    app.state.pdf_pool = ProcessPoolExecutor(
+        max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver")
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if intellisign_client is not None:
+        await intellisign_client.close()
+    if consent_store is not None:
+        await consent_store.aclose()
+    app.state.pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_client() -> IntellisignClient:
+    if intellisign_client is None:
+        raise HTTPException(status_code=503, detail="Cliente Intellisign não inicializado")
+    return intellisign_client
+
+
+def _consent_key(document_id: str) -> str:
+    return f"consent:{document_id}"
+
+
+async def load_consent(document_id: str) -> Dict | None:
+    raw = await consent_store.get(_consent_key(document_id))
+    if raw is None:
+        return None
+    return orjson.loads(raw)
+
+
+async def save_consent(document_id: str, info: Dict):
+    await consent_store.set(
+        _consent_key(document_id), orjson.dumps(info), ex=CONSENT_TTL_SECONDS
+    )
+
+
+# Renovação e liberação só valem se a chave ainda guarda a reserva desta requisição
+_REFRESH_RESERVATION_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_RESERVATION_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def new_reservation(consent_id: str, email: str) -> bytes:
+    # O token torna cada reserva única, para só a requisição dona renová-la ou liberá-la
+    return orjson.dumps({
+        "consentId": consent_id,
+        "email": email,
+        "envelopeId": None,
+        "status": SENDING_STATUS,
+        "signedAt": None,
+        "downloadAvailable": False,
+        "reservation": uuid.uuid4().hex,
+    })
+
+
+async def reserve_document(document_id: str, reservation: bytes) -> Dict | None:
+    """
+    Reserva o documentId atomicamente (SET NX) antes do envio.
+    Retorna None se a reserva foi obtida; senão o registro existente. Se outro
+    envio do mesmo documento está em andamento, espera até SEND_RESERVATION_WAIT_SECONDS
+    e devolve o registro (ainda com status "sending" se não terminou).
+    """
+    deadline = time.monotonic() + SEND_RESERVATION_WAIT_SECONDS
+    while True:
+        if await consent_store.set(
+            _consent_key(document_id), reservation, nx=True, ex=SEND_RESERVATION_SECONDS
+        ):
+            return None
+        info = await load_consent(document_id)
+        if info is None:
+            # Reserva liberada ou expirada entre o SET e o GET: tenta de novo
+            continue
+        if info["status"] != SENDING_STATUS or time.monotonic() >= deadline:
+            return info
+        await asyncio.sleep(0.5)
+
+
+def refresh_reservations(reservations: Dict[str, bytes]) -> asyncio.Task:
+    """
+    Renova as reservas (documentId -> reserva) a cada SEND_RESERVATION_SECONDS / 3,
+    para um envio lento não perder a reserva no meio. O chamador cancela a tarefa no fim.
+    """
+
+    async def refresh():
+        while True:
+            await asyncio.sleep(SEND_RESERVATION_SECONDS / 3)
+            for document_id, reservation in reservations.items():
+                try:
+                    await consent_store.eval(
+                        _REFRESH_RESERVATION_SCRIPT, 1, _consent_key(document_id),
+                        reservation, SEND_RESERVATION_SECONDS,
+                    )
+                except aioredis.RedisError as e:
+                    logger.warning(
+                        "Falha ao renovar reserva do documento",
+                        extra={"documentId": document_id, "err": str(e)},
+                    )
+
+    return asyncio.create_task(refresh())
+
+
+async def release_reservation(document_id: str, reservation: bytes):
+    # Envio falhou: libera o documentId para uma nova tentativa (se a reserva ainda é nossa)
+    await consent_store.eval(_RELEASE_RESERVATION_SCRIPT, 1, _consent_key(document_id), reservation)
+
+
+def _envelope_key(envelope_id: str) -> str:
+    return f"envelope:{envelope_id}"
+
+
+async def save_envelope_index(envelope_id: str, document_id: str):
+    # envelopeId -> documentId, usado pelo webhook
+    await consent_store.set(_envelope_key(envelope_id), document_id, ex=CONSENT_TTL_SECONDS)
+
+
+async def find_document_by_envelope(envelope_id: str) -> str | None:
+    raw = await consent_store.get(_envelope_key(envelope_id))
+    return raw.decode() if raw is not None else None
 
 
 class SendConsentRequest(BaseModel):
@@ -66,18 +347,35 @@ class ConsentStatusResponse(BaseModel):
     downloadUrl: str | None = None
 
 
+class BulkConsentResult(ConsentStatusResponse):
+    error: str | None = None
+
+
 # ------------------ Util: gerar PDF do texto ------------------
 
 def generate_pdf_from_text(content: str, output_path: Path):
     """
     Gera um PDF simples com o texto do termo.
     """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    _draw_text_pdf(content, str(output_path))
+
+
+def render_pdf_from_text(content: str) -> bytes:
+    """
+    Mesmo PDF de generate_pdf_from_text, devolvido em bytes (para o cache).
+    """
+    buffer = io.BytesIO()
+    _draw_text_pdf(content, buffer)
+    return buffer.getvalue()
+
+
+def _draw_text_pdf(content: str, target: str | BinaryIO):
     from reportlab.lib.pagesizes import A4
     from reportlab.pdfgen import canvas
 
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-
-    c = canvas.Canvas(str(output_path), pagesize=A4)
+    # invariant=1: mesmo texto gera os mesmos bytes (o documentId é o hash do PDF)
+    c = canvas.Canvas(target, pagesize=A4, invariant=1)
     width, height = A4
 
     # Margens simples
@@ -93,18 +391,171 @@ def generate_pdf_from_text(content: str, output_path: Path):
         wrapped = wrap(paragraph, width=100) or [""]
         lines.extend(wrapped)
 
-    c.setFont("Helvetica", 11)
-    for line in lines:
-        if y < 50:
+    # Um único text object (BT/ET) por página em vez de um drawString por linha
+    leading = 14
+    lines_per_page = int((height - 100) // leading) + 1
+    for start in range(0, len(lines), lines_per_page):
+        if start:
             c.showPage()
-            c.setFont("Helvetica", 11)
-            y = height - 50
-        c.drawString(x, y, line)
-        y -= 14
+        text = c.beginText(x, y)
+        text.setFont("Helvetica", 11)
+        text.setLeading(leading)
+        text.textLines(lines[start:start + lines_per_page], trim=0)
+        c.drawText(text)
 
     c.save()
 
 
+async def write_pdf_from_text(content: str, pdf_path: Path):
+    """
+    Gera o PDF do texto no pool de processos. Textos curtos reaproveitam os
+    bytes já renderizados (LRU), e a requisição só grava o arquivo.
+    """
+    loop = asyncio.get_running_loop()
+    if len(content) > PDF_CACHE_MAX_CONTENT:
+        await loop.run_in_executor(app.state.pdf_pool, generate_pdf_from_text, content, pdf_path)
+        return
+
+    future = _pdf_cache.get(content)
+    if future is None:
+        future = loop.run_in_executor(app.state.pdf_pool, render_pdf_from_text, content)
+        _pdf_cache[content] = future
+        if len(_pdf_cache) > PDF_CACHE_SIZE:
+            _pdf_cache.popitem(last=False)
+    else:
+        _pdf_cache.move_to_end(content)
+    try:
+        pdf_bytes = await asyncio.shield(future)
+    except Exception:
+        if _pdf_cache.get(content) is future:
+            del _pdf_cache[content]
+        raise
+
+    await aiofiles.os.makedirs(pdf_path.parent, exist_ok=True)
+    async with aiofiles.open(pdf_path, "wb") as dest:
+        await dest.write(pdf_bytes)
+
+
+def raise_for_gather_errors(results: list):
+    """
+    Junta as falhas de um asyncio.gather(..., return_exceptions=True) num
+    único IntellisignAPIError. Exceções inesperadas sobem sem alteração.
+    """
+    errors = [r for r in results if isinstance(r, BaseException)]
+    for err in errors:
+        if not isinstance(err, IntellisignAPIError):
+            raise err
+    if errors:
+        raise IntellisignAPIError("; ".join(str(e) for e in errors))
+
+
+async def attach_document_and_signer(
+    client: IntellisignClient,
+    token: str,
+    envelope_id: str,
+    pdf_path: Path,
+    email: str,
+    sem: asyncio.Semaphore | None = None,
+):
+    """
+    Upload do PDF e signatário são independentes depois que o envelope
+    existe, então rodam em paralelo. Com sem, cada chamada ocupa uma vaga.
+    """
+    calls = [
+        client.add_document(token, envelope_id, pdf_path, filename=pdf_path.name),
+        client.add_recipient(
+            token,
+            envelope_id,
+            name=SIGNER_NAME_DEFAULT,  # se quiser, pode mandar o nome no payload depois
+            email=email,
+            signature_type="simple",
+        ),
+    ]
+    if sem is not None:
+        calls = [_bounded(sem, call) for call in calls]
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    raise_for_gather_errors(results)
+
+
+async def store_sent_consent(document_id: str, consent_id: str, email: str, envelope_id: str):
+    await save_consent(document_id, {
+        "consentId": consent_id,
+        "email": email,
+        "envelopeId": envelope_id,
+        "status": "sent",
+        "signedAt": None,
+        "downloadAvailable": False,
+        "signedFile": str(UPLOAD_ROOT / document_id / "signed" / "signed.pdf"),
+        "lastCheckedAt": None,
+        "lastEnvStatus": None,
+        "downloadLink": None,
+    })
+    await save_envelope_index(envelope_id, document_id)
+
+
+def new_document_digest(consent_id: str, email: str):
+    """
+    SHA-256 que identifica o documento: consentId + email + bytes do PDF.
+    O mesmo PDF para outro signatário ou consentimento gera outro id.
+    """
+    digest = hashlib.sha256(usedforsecurity=False)
+    digest.update(f"{consent_id}\0{email}\0".encode())
+    return digest
+
+
+def hash_file(path: Path, digest) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, lambda: digest).hexdigest()
+
+
+async def discard_dir(path: Path):
+    await asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, path, True)
+
+
+async def claim_document_dir(incoming_dir: Path, document_id: str) -> Path:
+    """
+    Move o diretório temporário para UPLOAD_ROOT/{documentId}.
+    Só é chamado com a reserva do documentId obtida: se o diretório já existir,
+    é sobra de um envio que falhou, com o mesmo conteúdo, e é substituído.
+    """
+    base_dir = UPLOAD_ROOT / document_id
+    if await aiofiles.os.path.exists(base_dir):
+        await discard_dir(base_dir)
+    await aiofiles.os.rename(incoming_dir, base_dir)
+    return base_dir
+
+
+def consent_response(document_id: str, info: Dict, download_url: str | None = None) -> ConsentStatusResponse:
+    return ConsentStatusResponse(
+        status=info["status"],
+        documentId=document_id,
+        consentId=info["consentId"],
+        envelopeId=info["envelopeId"],
+        signedAt=info.get("signedAt"),
+        downloadAvailable=bool(info.get("downloadAvailable")),
+        downloadUrl=download_url,
+    )
+
+
+def attachment_disposition(filename: str) -> str:
+    # Igual ao FileResponse: nomes com acentos ou aspas vão percent-encoded em filename*
+    quoted = urllib.parse.quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def download_url_for(request: Request, document_id: str, info: Dict) -> str | None:
+    if not info.get("downloadAvailable"):
+        return None
+    return str(request.url_for("download_consent", document_id=document_id))
+
+
+async def _bounded(sem: asyncio.Semaphore, coro):
+    async with sem:
+        return await coro
+
+
 # ------------------ Endpoints ------------------
 
 @app.get("/health")
@@ -114,11 +565,13 @@ def health():
 
 @app.post("/api/consents/send", response_model=ConsentStatusResponse)
 async def send_consent(
+    request: Request,
     email: str | None = Form(None),
     consentId: str | None = Form(None),
     content: str | None = Form(None),
     file: UploadFile | None = File(None),
     json_payload: SendConsentRequest | None = Body(None),
+    client: IntellisignClient = Depends(get_client),
 ):
     """
     Recebe via multipart/form-data:
@@ -139,67 +592,99 @@ async def send_consent(
     if not email or not consentId:
         raise HTTPException(status_code=400, detail="Campos obrigatórios: email, consentId")
 
-    document_id = str(uuid.uuid4())
-    logger.info("Preparando documento para consentId=%s, documentId=%s", consentId, document_id)
-
     if not file and not content:
         raise HTTPException(status_code=400, detail="Envie um PDF em 'file' ou texto em 'content'")
 
-    # 1) Armazenar PDF local (arquivo enviado ou gerado do texto)
-    base_dir = UPLOAD_ROOT / document_id
-    original_dir = base_dir / "original"
-    signed_dir = base_dir / "signed"
+    # 1) Armazenar PDF local (arquivo enviado ou gerado do texto) num diretório
+    # temporário, calculando o hash que vira o documentId
+    incoming_dir = INCOMING_ROOT / str(uuid.uuid4())
+    original_dir = incoming_dir / "original"
     pdf_path = original_dir / "consent.pdf"
-    original_dir.mkdir(parents=True, exist_ok=True)
+    digest = new_document_digest(consentId, email)
 
     if file:
         if not file.filename.lower().endswith(".pdf"):
             raise HTTPException(status_code=400, detail="Apenas PDF é aceito em 'file'")
-        pdf_path = original_dir / (file.filename or "consent.pdf")
-        contents = await file.read()
-        with pdf_path.open("wb") as dest:
-            dest.write(contents)
+        # Segunda linha de defesa: o BodySizeLimitMiddleware já recusou corpos grandes
+        if file.size is not None and file.size > MAX_PDF_BYTES:
+            raise HTTPException(status_code=413, detail="PDF excede o tamanho máximo")
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk.startswith(PDF_MAGIC):
+            raise HTTPException(status_code=400, detail="Arquivo enviado não é um PDF válido")
+
+        # Só o nome: o filename do cliente não pode apontar para fora do diretório
+        pdf_path = original_dir / Path(file.filename).name
+        await aiofiles.os.makedirs(original_dir, exist_ok=True)
+        # Copia em blocos para não manter o PDF inteiro em memória
+        total = 0
+        try:
+            async with aiofiles.open(pdf_path, "wb") as dest:
+                while chunk:
+                    total += len(chunk)
+                    if total > MAX_PDF_BYTES:
+                        raise HTTPException(status_code=413, detail="PDF excede o tamanho máximo")
+                    digest.update(chunk)
+                    await dest.write(chunk)
+                    chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        except HTTPException:
+            await discard_dir(incoming_dir)
+            raise
+        document_id = digest.hexdigest()
     else:
-        generate_pdf_from_text(content or "", pdf_path)
+        await write_pdf_from_text(content or "", pdf_path)
+        document_id = await asyncio.get_running_loop().run_in_executor(
+            None, hash_file, pdf_path, digest
+        )
+
+    logger.info("Preparando documento para consentId=%s, documentId=%s", consentId, document_id)
 
+    # Mesmo documento já enviado (ou em envio): devolve o estado guardado sem reenviar
+    reservation = new_reservation(consentId, email)
+    info = await reserve_document(document_id, reservation)
+    if info:
+        await discard_dir(incoming_dir)
+        if info["status"] == SENDING_STATUS:
+            raise HTTPException(status_code=409, detail="Envio do documento já em andamento")
+        logger.info("Documento %s já enviado, reaproveitando envelope %s", document_id, info["envelopeId"])
+        return consent_response(document_id, info, download_url_for(request, document_id, info))
+
+    sent = False
+    refresher = refresh_reservations({document_id: reservation})
     try:
+        base_dir = await claim_document_dir(incoming_dir, document_id)
+        pdf_path = base_dir / "original" / pdf_path.name
+
         # 2) Token Intellisign
-        token = client.get_access_token()
+        token = await client.get_access_token()
 
         # 3) Envelope
         subject = f"Consentimento - {consentId}"
-        message = "Por favor, assine o termo de consentimento enviado pelo sistema."
-        envelope_id = client.create_envelope(token, name=subject, subject=subject, message=message)
-
-        # 4) Upload do PDF
-        client.add_document(token, envelope_id, pdf_path, filename=pdf_path.name)
-
-        # 5) Adicionar signatário (email do usuário conectado)
-        client.add_recipient(
-            token,
-            envelope_id,
-            name=SIGNER_NAME_DEFAULT,  # se quiser, pode mandar o nome no payload depois
-            email=email,
-            signature_type="simple",
+        envelope_id = await client.create_envelope(
+            token, name=subject, subject=subject, message=ENVELOPE_MESSAGE
         )
 
+        # 4+5) Upload do PDF e signatário (email do usuário conectado), em paralelo
+        await attach_document_and_signer(client, token, envelope_id, pdf_path, email)
+
         # 6) Enviar envelope
-        client.send_envelope(token, envelope_id)
+        await client.send_envelope(token, envelope_id)
+        sent = True
 
     except IntellisignAPIError as e:
-        logger.exception("Falha ao enviar envelope para Intellisign")
+        # Erro esperado da API: sem traceback, exceto em DEBUG
+        logger.warning(
+            "Falha ao enviar envelope para Intellisign",
+            extra={"consentId": consentId, "documentId": document_id, "err": str(e)},
+            exc_info=logger.isEnabledFor(logging.DEBUG),
+        )
         raise HTTPException(status_code=502, detail=str(e))
+    finally:
+        refresher.cancel()
+        if not sent:
+            await release_reservation(document_id, reservation)
 
-    # Guardar estado em memória
-    CONSENT_STORE[document_id] = {
-        "consentId": consentId,
-        "email": email,
-        "envelopeId": envelope_id,
-        "status": "sent",
-        "signedAt": None,
-        "downloadAvailable": False,
-        "signedFile": signed_dir / "signed.pdf",
-    }
+    # Guardar estado no Redis
+    await store_sent_consent(document_id, consentId, email, envelope_id)
 
     return ConsentStatusResponse(
         status="sent",
@@ -211,76 +696,408 @@ async def send_consent(
     )
 
 
+@app.post("/api/consents/bulk", response_model=list[BulkConsentResult])
+async def send_consents_bulk(
+    payload: list[SendConsentRequest],
+    request: Request,
+    client: IntellisignClient = Depends(get_client),
+):
+    """
+    Envia vários consentimentos (JSON, com 'content' em texto) de uma vez.
+    Um único token serve o lote inteiro e cada etapa (criar envelope,
+    upload + signatário, envio) roda em paralelo para todos os itens,
+    limitada a BULK_CONCURRENCY chamadas simultâneas.
+    Falhas são por item: o item falho para na etapa em que falhou.
+    """
+    if not INTELLISIGN_CLIENT_ID or not INTELLISIGN_CLIENT_SECRET:
+        raise HTTPException(status_code=500, detail="Intellisign não configurado")
+    if not payload:
+        raise HTTPException(status_code=400, detail="Envie ao menos um consentimento")
+    if len(payload) > BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413, detail=f"Lote excede o máximo de {BULK_MAX_ITEMS} consentimentos"
+        )
+    if any(not item.content for item in payload):
+        raise HTTPException(status_code=400, detail="Cada item precisa de texto em 'content'")
+
+    incoming_dirs = [INCOMING_ROOT / str(uuid.uuid4()) for _ in payload]
+    pdf_paths = [incoming_dir / "original" / "consent.pdf" for incoming_dir in incoming_dirs]
+    logger.info("Preparando lote de %d consentimentos", len(payload))
+
+    # 1) Gerar os PDFs no pool de processos e calcular os documentIds (hash)
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[
+        write_pdf_from_text(item.content, pdf_path)
+        for item, pdf_path in zip(payload, pdf_paths)
+    ])
+    document_ids = await asyncio.gather(*[
+        loop.run_in_executor(None, hash_file, pdf_path, new_document_digest(item.consentId, item.email))
+        for item, pdf_path in zip(payload, pdf_paths)
+    ])
+
+    # Repetidos dentro do lote reaproveitam o resultado do primeiro
+    first_index: Dict[str, int] = {}
+    for i, document_id in enumerate(document_ids):
+        first_index.setdefault(document_id, i)
+    unique = sorted(first_index.values())
+
+    # Documentos já enviados (ou em envio) não são reenviados
+    stored: list[Dict | None] = [None] * len(payload)
+    reservations = {i: new_reservation(payload[i].consentId, payload[i].email) for i in unique}
+    reserved = await asyncio.gather(*[
+        reserve_document(document_ids[i], reservations[i]) for i in unique
+    ])
+    for i, info in zip(unique, reserved):
+        stored[i] = info
+    to_send = [i for i in unique if stored[i] is None]
+
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+    envelope_ids: list[str | None] = [None] * len(payload)
+    errors: list[str | None] = [None] * len(payload)
+    sent = [False] * len(payload)
+
+    async def run_stage(make_call, on_success=None, bounded: bool = True):
+        pending = [i for i in to_send if errors[i] is None]
+        results = await asyncio.gather(
+            *[_bounded(sem, make_call(i)) if bounded else make_call(i) for i in pending],
+            return_exceptions=True,
+        )
+        unexpected = None
+        for i, result in zip(pending, results):
+            if isinstance(result, IntellisignAPIError):
+                errors[i] = str(result)
+            elif isinstance(result, BaseException):
+                errors[i] = repr(result)
+                unexpected = unexpected or result
+            elif on_success is not None:
+                on_success(i, result)
+        if unexpected is not None:
+            raise unexpected
+
+    # 2) Envelopes
+    def create(i: int):
+        subject = f"Consentimento - {payload[i].consentId}"
+        return client.create_envelope(token, name=subject, subject=subject, message=ENVELOPE_MESSAGE)
+
+    def created(i: int, envelope_id: str):
+        envelope_ids[i] = envelope_id
+
+    def delivered(i: int, _):
+        sent[i] = True
+
+    refresher = refresh_reservations({document_ids[i]: reservations[i] for i in to_send})
+    try:
+        for i, incoming_dir in enumerate(incoming_dirs):
+            if i not in to_send:
+                await discard_dir(incoming_dir)
+                continue
+            base_dir = await claim_document_dir(incoming_dir, document_ids[i])
+            pdf_paths[i] = base_dir / "original" / "consent.pdf"
+
+        token = ""
+        if to_send:
+            try:
+                token = await client.get_access_token()
+            except IntellisignAPIError as e:
+                logger.warning(
+                    "Falha ao obter token do Intellisign",
+                    extra={"batchSize": len(payload), "err": str(e)},
+                    exc_info=logger.isEnabledFor(logging.DEBUG),
+                )
+                raise HTTPException(status_code=502, detail=str(e))
+
+        await run_stage(create, created)
+
+        # 3) Upload do PDF + signatário (cada uma das duas chamadas ocupa uma vaga)
+        await run_stage(lambda i: attach_document_and_signer(
+            client, token, envelope_ids[i], pdf_paths[i], payload[i].email, sem
+        ), bounded=False)
+
+        # 4) Envio
+        await run_stage(
+            lambda i: client.send_envelope(token, envelope_ids[i]), delivered
+        )
+    finally:
+        refresher.cancel()
+        # Os envelopes já enviados são sempre registrados, mesmo se o lote abortar,
+        # para um novo envio do cliente não notificar o signatário de novo;
+        # os demais liberam a reserva
+        for i in to_send:
+            if sent[i]:
+                await store_sent_consent(
+                    document_ids[i], payload[i].consentId, payload[i].email, envelope_ids[i]
+                )
+            else:
+                await release_reservation(document_ids[i], reservations[i])
+
+    responses: list[BulkConsentResult] = []
+    for i, item in enumerate(payload):
+        document_id = document_ids[i]
+        if first_index[document_id] != i:
+            responses.append(responses[first_index[document_id]])
+            continue
+        if stored[i] and stored[i]["status"] == SENDING_STATUS:
+            responses.append(BulkConsentResult(
+                status="failed",
+                documentId=document_id,
+                consentId=item.consentId,
+                error="Envio do documento já em andamento",
+            ))
+            continue
+        if stored[i]:
+            download_url = download_url_for(request, document_id, stored[i])
+            responses.append(BulkConsentResult(
+                **consent_response(document_id, stored[i], download_url).model_dump()
+            ))
+            continue
+        if errors[i] is not None:
+            logger.warning(
+                "Falha ao enviar consentimento do lote",
+                extra={"consentId": item.consentId, "documentId": document_id, "err": errors[i]},
+            )
+        responses.append(BulkConsentResult(
+            status="sent" if errors[i] is None else "failed",
+            documentId=document_id,
+            consentId=item.consentId,
+            envelopeId=envelope_ids[i],
+            error=errors[i],
+        ))
+    return responses
+
+
 @app.get("/api/consents/{document_id}/status", response_model=ConsentStatusResponse)
-def get_consent_status(document_id: str, request: Request):
+async def get_consent_status(
+    document_id: str,
+    request: Request,
+    client: IntellisignClient = Depends(get_client),
+):
     """
     Consulta status local + status do envelope no Intellisign.
     (Aqui, para simplificar, vamos assumir que se o envelope estiver 'completed',
-    fazemos o download do PDF final e marcamos como concluído.)
+    marcamos como concluído; com UPLOAD_PERSIST=1 também baixamos o PDF final.)
     """
-    info = CONSENT_STORE.get(document_id)
+    info = await load_consent(document_id)
     if not info:
         raise HTTPException(status_code=404, detail="Documento não encontrado")
 
     status = info["status"]
     envelope_id = info["envelopeId"]
 
-    # Se ainda não completou, consulta Intellisign
-    if status != "completed":
+    # Se ainda não completou, consulta Intellisign (exceto durante o envio ou quando a
+    # última consulta foi há pouco; com webhook, o intervalo é o do fallback)
+    cache_seconds = WEBHOOK_STATUS_CACHE_SECONDS if INTELLISIGN_WEBHOOK_SECRET else STATUS_CACHE_SECONDS
+    last_checked_at = info.get("lastCheckedAt") or 0.0
+    if (
+        status not in ("completed", SENDING_STATUS)
+        and time.time() - last_checked_at >= cache_seconds
+    ):
         try:
-            token = client.get_access_token()
-            env_data = client.get_envelope_status(token, envelope_id)
+            token = await client.get_access_token()
+            env_data = await client.get_envelope_status(token, envelope_id)
             env_status = (env_data.get("status") or "").lower()
+            info["lastCheckedAt"] = time.time()
+            info["lastEnvStatus"] = env_status
             # Ajuste esta lógica conforme o campo real usado por Intellisign
-            if env_status in ("completed", "signed", "finished"):
-                # Baixa o PDF final
-                signed_path: Path = info["signedFile"]
-                client.download_completed_document(token, envelope_id, signed_path)
+            if env_status in COMPLETED_ENVELOPE_STATUSES:
+                # Guarda o link para o download não precisar consultar o envelope de novo
+                info["downloadLink"] = client.resolve_download_link(envelope_id, env_data)
+                # Baixa o PDF final (sem persistência, o /download busca direto no Intellisign;
+                # com webhook, o /download baixa a cópia local sob demanda)
+                if UPLOAD_PERSIST and not INTELLISIGN_WEBHOOK_SECRET:
+                    await save_signed_file(client, document_id, info)
                 info["status"] = "completed"
                 info["downloadAvailable"] = True
                 info["signedAt"] = datetime.utcnow()
-                status = "completed"
+            await save_consent(document_id, info)
         except IntellisignAPIError as e:
             # Não falhar duro na consulta de status, apenas logar
-            logger.warning("Erro ao consultar envelope no Intellisign: %s", e)
-
-    download_url = None
-    if info.get("downloadAvailable"):
-        download_url = str(request.url_for("download_consent", document_id=document_id))
+            logger.warning(
+                "Erro ao consultar envelope no Intellisign",
+                extra={"documentId": document_id, "envelopeId": envelope_id, "err": str(e)},
+                exc_info=logger.isEnabledFor(logging.DEBUG),
+            )
 
-    return ConsentStatusResponse(
-        status=status,
-        documentId=document_id,
-        consentId=info["consentId"],
-        envelopeId=envelope_id,
-        signedAt=info.get("signedAt"),
-        downloadAvailable=bool(info.get("downloadAvailable")),
-        downloadUrl=download_url,
-    )
+    return consent_response(document_id, info, download_url_for(request, document_id, info))
 
 
 @app.get("/api/consents/{document_id}/download")
-def download_consent(document_id: str):
+async def download_consent(
+    document_id: str,
+    client: IntellisignClient = Depends(get_client),
+):
     """
     Faz o download do PDF assinado, se já estiver disponível.
+    Sem cópia local, repassa o PDF do Intellisign em streaming.
     """
-    info = CONSENT_STORE.get(document_id)
+    info = await load_consent(document_id)
     if not info:
         raise HTTPException(status_code=404, detail="Documento não encontrado")
 
     if info.get("status") != "completed":
         raise HTTPException(status_code=400, detail="Documento ainda não está assinado")
 
-    signed_path: Path = info["signedFile"]
-    if not signed_path.exists():
-        raise HTTPException(status_code=404, detail="Arquivo assinado ainda não disponível")
-
     filename = f"consent_{info['consentId']}.pdf"
-    return FileResponse(
-        path=signed_path,
+    headers = {"Cache-Control": DOWNLOAD_CACHE_CONTROL}
+
+    signed_path = Path(info["signedFile"])
+    if await aiofiles.os.path.exists(signed_path):
+        return FileResponse(
+            path=signed_path,
+            media_type="application/pdf",
+            filename=filename,
+            headers=headers,
+        )
+    if UPLOAD_PERSIST:
+        # A cópia local ainda não existe (ex.: o download em background do webhook
+        # falhou ou se perdeu): baixa agora em vez de deixar o PDF inacessível
+        try:
+            await save_signed_file(client, document_id, info)
+        except IntellisignAPIError as e:
+            logger.warning(
+                "Erro ao baixar documento do Intellisign",
+                extra={"documentId": document_id, "envelopeId": info["envelopeId"], "err": str(e)},
+                exc_info=logger.isEnabledFor(logging.DEBUG),
+            )
+            raise HTTPException(status_code=502, detail=str(e))
+        return FileResponse(
+            path=signed_path,
+            media_type="application/pdf",
+            filename=filename,
+            headers=headers,
+        )
+
+    # Monta os headers antes de abrir a resposta do Intellisign, que precisa ser liberada
+    headers["Content-Disposition"] = attachment_disposition(filename)
+    try:
+        token = await client.get_access_token()
+        resp, download_link = await client.open_completed_document(
+            token, info["envelopeId"], info.get("downloadLink")
+        )
+    except IntellisignAPIError as e:
+        logger.warning(
+            "Erro ao baixar documento do Intellisign",
+            extra={"documentId": document_id, "envelopeId": info["envelopeId"], "err": str(e)},
+            exc_info=logger.isEnabledFor(logging.DEBUG),
+        )
+        raise HTTPException(status_code=502, detail=str(e))
+    try:
+        await remember_download_link(document_id, info, download_link)
+    except BaseException:
+        resp.release()
+        raise
+
+    # Libera a conexão mesmo se o cliente cair antes de o corpo começar a ser lido
+    return StreamingResponse(
+        iter_response_chunks(resp),
         media_type="application/pdf",
-        filename=filename,
+        headers=headers,
+        background=BackgroundTask(release_response, resp),
     )
 
 
+async def release_response(resp):
+    # async para rodar no event loop: BackgroundTask leva funções síncronas para o
+    # threadpool, e o connector do aiohttp não é thread-safe
+    resp.release()
+
+
+async def remember_download_link(document_id: str, info: Dict, download_link: str):
+    # O link guardado falhou (ex.: expirou) e o cliente resolveu outro: guarda o novo
+    if download_link != info.get("downloadLink"):
+        info["downloadLink"] = download_link
+        await save_consent(document_id, info)
+
+
+async def save_signed_file(client: IntellisignClient, document_id: str, info: Dict):
+    """
+    Grava a cópia local do PDF assinado. Baixa para um arquivo temporário e
+    renomeia no fim, para nunca servir um PDF pela metade.
+    """
+    signed_path = Path(info["signedFile"])
+    partial_path = signed_path.with_name(f".{signed_path.name}.{uuid.uuid4()}.part")
+    token = await client.get_access_token()
+    try:
+        download_link = await client.download_completed_document(
+            token, info["envelopeId"], partial_path, info.get("downloadLink")
+        )
+        await aiofiles.os.replace(partial_path, signed_path)
+    except BaseException:
+        if await aiofiles.os.path.exists(partial_path):
+            await aiofiles.os.remove(partial_path)
+        raise
+    await remember_download_link(document_id, info, download_link)
+
+
+async def fetch_signed_document(client: IntellisignClient, document_id: str):
+    """
+    Pré-baixa o PDF assinado em background depois que o webhook marcou o
+    consentimento como concluído. Se falhar, o /download baixa sob demanda.
+    """
+    info = await load_consent(document_id)
+    if not info:
+        return
+    try:
+        await save_signed_file(client, document_id, info)
+    except IntellisignAPIError as e:
+        logger.warning(
+            "Erro ao baixar documento assinado",
+            extra={"documentId": document_id, "envelopeId": info["envelopeId"], "err": str(e)},
+            exc_info=logger.isEnabledFor(logging.DEBUG),
+        )
+
+
+@app.post("/api/intellisign/webhook")
+async def intellisign_webhook(
+    request: Request,
+    client: IntellisignClient = Depends(get_client),
+):
+    """
+    Recebe eventos do Intellisign. O corpo deve vir assinado com
+    HMAC-SHA256 (INTELLISIGN_WEBHOOK_SECRET) no header X-Intellisign-Signature.
+    Quando o envelope conclui, marca o consentimento e baixa o PDF em background.
+    """
+    if not INTELLISIGN_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Webhook não configurado")
+
+    body = await request.body()
+    expected = hmac.new(INTELLISIGN_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    signature = request.headers.get(WEBHOOK_SIGNATURE_HEADER, "")
+    # Compara bytes: com str, um header não-ASCII faria compare_digest levantar TypeError
+    if not hmac.compare_digest(expected.encode(), signature.encode("latin-1")):
+        raise HTTPException(status_code=401, detail="Assinatura inválida")
+
+    try:
+        event = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="JSON inválido")
+
+    envelope_id = event.get("envelope_id") or event.get("id")
+    env_status = (event.get("status") or "").lower()
+    if not envelope_id:
+        raise HTTPException(status_code=400, detail="Evento sem envelope_id")
+
+    document_id = await find_document_by_envelope(envelope_id)
+    info = await load_consent(document_id) if document_id else None
+    if not info:
+        raise HTTPException(status_code=404, detail="Documento não encontrado")
+
+    info["lastEnvStatus"] = env_status
+    info["lastCheckedAt"] = time.time()
+    if env_status in COMPLETED_ENVELOPE_STATUSES and info["status"] != "completed":
+        info["status"] = "completed"
+        info["signedAt"] = datetime.utcnow()
+        # O /download repassa o PDF do Intellisign ou, com UPLOAD_PERSIST=1,
+        # baixa a cópia local sob demanda se o download em background não terminou
+        info["downloadAvailable"] = True
+        await save_consent(document_id, info)
+        if UPLOAD_PERSIST:
+            task = asyncio.create_task(fetch_signed_document(client, document_id))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+    else:
+        await save_consent(document_id, info)
+
+    return {"ok": True}
+
+
 # Depois você pode evoluir isso pra salvar em banco ou em bucket (GCS) em vez de disk local, mas pra MVP no Cloud Run já funciona (pasta /app/uploads).